@@ -0,0 +1,79 @@
+# Copyright 2015 The Baker Street Authors. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+The parts of the metrics endpoints that Sherlock and Watson share. Each keeps its own Metrics class, whose snapshot()
+is what MetricsServer serves.
+"""
+
+import json
+import logging
+from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+from threading import Thread
+
+__all__ = ["Histogram", "MetricsServer"]
+
+log = logging.getLogger()
+
+
+class Histogram(object):
+
+    """Counts observations into cumulative buckets, like a Prometheus histogram"""
+
+    bounds = (0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 2, 5, 10, 30, 60)
+
+    def __init__(self):
+        self.count = 0
+        self.sum = 0.0
+        self.buckets = [0] * len(self.bounds)
+
+    def observe(self, value):
+        self.count += 1
+        self.sum += value
+        for index, bound in enumerate(self.bounds):
+            if value <= bound:
+                self.buckets[index] += 1
+
+    def snapshot(self):
+        buckets = dict((str(bound), count) for bound, count in zip(self.bounds, self.buckets))
+        buckets["+Inf"] = self.count
+        return dict(count=self.count, sum=self.sum, buckets=buckets)
+
+
+class MetricsHandler(BaseHTTPRequestHandler):
+
+    def do_GET(self):
+        body = json.dumps(self.server.metrics.snapshot(), sort_keys=True)
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        log.debug("metrics request from %s: %s", self.client_address[0], format % args)
+
+
+class MetricsServer(Thread):
+
+    """Serves a JSON snapshot of the metrics over HTTP"""
+
+    def __init__(self, metrics, address, port):
+        Thread.__init__(self, name="metrics")
+        self.daemon = True
+        self.httpd = HTTPServer((address, port), MetricsHandler)
+        self.httpd.metrics = metrics
+
+    def run(self):
+        self.httpd.serve_forever()
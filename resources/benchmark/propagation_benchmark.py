@@ -0,0 +1,447 @@
+#!/usr/bin/env python
+
+# Copyright 2015 The Baker Street Authors. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Propagation benchmark
+
+- Run Watson and Sherlock in one process around a stand-in for the directory, on a minimal event loop
+- Flip the health of randomly chosen services and time each flip until HAProxy has taken the routing change
+- Report the end-to-end latency and the time spent in each stage (Watson, directory, Sherlock, HAProxy) as
+  percentiles in milliseconds, as JSON
+
+HAProxy is stubbed with /bin/true unless --proxy names a real one (which then also needs a free bind address).
+
+Example:
+
+    propagation_benchmark.py --services 200 --flips 500 --watson-set fast_period=0.2 --sherlock-set debounce=1
+"""
+
+import heapq
+import imp
+import json
+import logging
+import os
+import random
+import shutil
+import signal
+import tempfile
+import time
+
+from argparse import ArgumentParser, Namespace
+from ConfigParser import RawConfigParser
+from StringIO import StringIO
+from threading import Condition
+from urlparse import urldefrag
+
+from sherlock_benchmark import REPO_ROOT, Event, Message, load_sherlock, make_args, percentiles
+
+
+def load_watson():
+    return imp.load_source("watson", os.path.join(REPO_ROOT, "watson"))
+
+
+class EventLoop(object):
+
+    """
+    Stands in for the proton reactor: runs timers and the calls other threads hand over, one at a time on the thread
+    that calls run(), with real time passing in between
+    """
+
+    def __init__(self):
+        self.condition = Condition()
+        self.timers = []  # heap of (due time, sequence number, task)
+        self.calls = []  # (function, args) handed over from other threads
+        self.sequence = 0
+        self.running = False
+
+    def schedule(self, delay, handler):
+        task = Task(self, handler)
+        with self.condition:
+            self.sequence += 1
+            heapq.heappush(self.timers, (time.time() + delay, self.sequence, task))
+            self.condition.notify()
+        return task
+
+    def selectable(self, injector):
+        pass
+
+    def call_soon(self, function, *args):
+        with self.condition:
+            self.calls.append((function, args))
+            self.condition.notify()
+
+    def stop(self):
+        self.running = False
+
+    def run(self):
+        self.running = True
+        while self.running:
+            with self.condition:
+                while not self.calls and not (self.timers and self.timers[0][0] <= time.time()):
+                    self.condition.wait(self.timers[0][0] - time.time() if self.timers else None)
+                calls, self.calls = self.calls, []
+                due = []
+                while self.timers and self.timers[0][0] <= time.time():
+                    due.append(heapq.heappop(self.timers)[2])
+            for function, args in calls:
+                function(*args)
+            for task in due:
+                if not task.cancelled:
+                    task.handler.on_timer_task(Event(None, self))
+
+
+class Task(object):
+
+    def __init__(self, loop, handler):
+        self.loop = loop
+        self.handler = handler
+        self.cancelled = False
+
+    def cancel(self):
+        self.cancelled = True
+
+
+class Injector(object):
+
+    """Stands in for the prober's event injector, handing its results back on the event loop"""
+
+    def __init__(self, loop, prober):
+        self.loop = loop
+        self.prober = prober
+
+    def trigger(self, event):
+        self.loop.call_soon(self.prober.on_probe_result, Event(None, self.loop))
+
+
+class Directory(object):
+
+    """
+    Stands in for the Datawire directory: tethers register and unregister targets, and every change reaches the
+    subscribers as a routes message, like the one the directory sends, after the configured delay
+    """
+
+    def __init__(self, loop, delay, harness):
+        self.loop = loop
+        self.delay = delay
+        self.harness = harness
+        self.routes = {}  # address -> { target: owner }
+        self.policies = {}  # address -> policy
+        self.subscribers = []
+
+    def tether(self, directory, address, target, policy=None):
+        return StandInTether(self, address, target, policy)
+
+    def update(self, address, target, policy, present):
+        targets = self.routes.setdefault(address, {})
+        if present:
+            targets[target] = "watson"
+            self.policies[address] = policy
+        else:
+            targets.pop(target, None)
+        self.harness.tethered(address, target, present)
+        self.loop.schedule(self.delay, Delivery(self, address))
+
+    def deliver(self, address):
+        message = Message(address, sorted(self.routes[address]), self.policies.get(address))
+        self.harness.delivered(address)
+        for subscriber in self.subscribers:
+            subscriber.on_message(Event(message, self.loop))
+
+
+class Delivery(object):
+
+    def __init__(self, directory, address):
+        self.directory = directory
+        self.address = address
+
+    def on_timer_task(self, event):
+        self.directory.deliver(self.address)
+
+
+class StandInTether(object):
+
+    def __init__(self, directory, address, target, policy):
+        self.directory = directory
+        self.address = address
+        self.target = target
+        self.policy = policy
+
+    def start(self, reactor):
+        self.directory.update(self.address, self.target, self.policy, True)
+
+    def stop(self, reactor):
+        self.directory.update(self.address, self.target, self.policy, False)
+
+
+class Switch(object):
+
+    """Stands in for a service's liveness test, reporting whatever health the harness last flipped it to"""
+
+    load = None
+
+    def __init__(self, target):
+        self.target = target
+        self.url = target
+        self.alive = True
+        self.cause = None
+
+    def __call__(self):
+        self.cause = None if self.alive else "refused"
+        return self.alive
+
+
+class Flip(object):
+
+    """One health flip of a service and the times (in seconds since the epoch) it passed each stage"""
+
+    def __init__(self, address, target, alive):
+        self.address = address
+        self.target = target
+        self.alive = alive
+        self.flipped = time.time()
+        self.tethered = None  # Watson started or stopped the tether
+        self.delivered = None  # the directory sent Sherlock the routes message
+        self.submitted = None  # Sherlock handed HAProxy the configuration
+        self.applied = None  # HAProxy took the configuration
+
+    def routed(self, routes):
+        targets = [urldefrag(target)[0] for target in routes.get(self.address, ([], None))[0]]
+        return (self.target in targets) == self.alive
+
+    def stages(self):
+        return dict(watson=self.tethered - self.flipped, directory=self.delivered - self.tethered,
+                    sherlock=self.submitted - self.delivered, haproxy=self.applied - self.submitted,
+                    total=self.applied - self.flipped)
+
+
+class WarmUpDeadline(object):
+
+    def __init__(self, harness):
+        self.harness = harness
+
+    def on_timer_task(self, event):
+        self.harness.warm_up_expired()
+
+
+class Harness(object):
+
+    """Flips the health of services one at a time and follows each flip through Watson, the directory and Sherlock"""
+
+    def __init__(self, loop, switches, flips, interval, timeout, seed):
+        self.loop = loop
+        self.switches = switches  # address -> Switch
+        self.random = random.Random(seed)
+        self.remaining = flips
+        self.interval = interval
+        self.timeout = timeout
+        self.pending = {}  # address -> Flip
+        self.completed = []
+        self.timed_out = 0
+        self.warm = False
+
+    def tethered(self, address, target, present):
+        flip = self.pending.get(address)
+        if flip and flip.tethered is None and present == flip.alive:
+            flip.tethered = time.time()
+
+    def delivered(self, address):
+        flip = self.pending.get(address)
+        if flip and flip.tethered is not None and flip.delivered is None:
+            flip.delivered = time.time()
+
+    def submitted(self, routes):
+        now = time.time()
+        for flip in self.pending.values():
+            if flip.delivered is not None and flip.submitted is None and flip.routed(routes):
+                flip.submitted = now
+
+    def warm_up_expired(self):
+        if not self.warm:
+            logging.error("Not every service was routed within %s seconds, giving up", self.timeout)
+            self.remaining = 0
+            self.loop.stop()
+
+    def applied(self, routes, now):
+        if not self.warm:
+            if all(Flip(address, switch.target, True).routed(routes) for address, switch in self.switches.items()):
+                logging.info("All services routed, starting to flip them")
+                self.warm = True
+                self.loop.schedule(0, self)
+            return
+        for address, flip in self.pending.items():
+            if flip.submitted is not None and flip.routed(routes):
+                flip.applied = now
+                self.completed.append(flip)
+                del self.pending[address]
+        self.check_done()
+
+    def on_timer_task(self, event):
+        now = time.time()
+        for address, flip in self.pending.items():
+            if now - flip.flipped > self.timeout:
+                logging.warning("Flip of %s not routed within %s seconds", address, self.timeout)
+                self.timed_out += 1
+                del self.pending[address]
+
+        idle = [address for address in self.switches if address not in self.pending]
+        if self.remaining and idle:
+            address = self.random.choice(idle)
+            switch = self.switches[address]
+            switch.alive = not switch.alive
+            self.pending[address] = Flip(address, switch.target, switch.alive)
+            self.remaining -= 1
+        if not self.check_done():
+            self.loop.schedule(self.interval, self)
+
+    def check_done(self):
+        if not self.remaining and not self.pending:
+            self.loop.stop()
+            return True
+        return False
+
+
+def measured_reloader(sherlock, reloader, loop, harness):
+
+    """Replaces Sherlock's reloader with one that tells the harness when HAProxy was handed and took each route map"""
+
+    class MeasuredReloader(sherlock.Reloader):
+
+        def submit(self, files, commands, reload, routes=None, changes=(), occupants=None):
+            harness.submitted(routes)
+            sherlock.Reloader.submit(self, files, commands, reload, routes, changes, occupants)
+
+        def save_snapshot(self, routes):
+            loop.call_soon(harness.applied, routes, time.time())
+            sherlock.Reloader.save_snapshot(self, routes)
+
+    return MeasuredReloader(reloader.pid_path, reloader.command, reloader.runtime, reloader.metrics,
+                            reloader.snapshot_path, reloader.state_path, reloader.bucket, reloader.draining)
+
+
+def stop_haproxy(server):
+
+    """Stops the HAProxy processes a real proxy left running, draining or not"""
+
+    pids = server.reloader.read_pids()
+    pids.extend(pid for _, generation in server.reloader.draining.generations for pid in generation)
+    for pid in pids:
+        try:
+            os.kill(pid, signal.SIGTERM)
+        except OSError:
+            pass
+
+
+def make_watson_services(watson, overrides, services):
+
+    """Builds the settings of each service from Watson's default configuration plus key=value overrides of [Watson]"""
+
+    config = RawConfigParser()
+    config.readfp(StringIO(watson.default_config))
+    for override in overrides:
+        key, _, value = override.partition("=")
+        config.set("Watson", key.strip(), value.strip())
+    for index in range(services):
+        section = "Watson:svc%d" % index
+        config.add_section(section)
+        config.set(section, "service_url", "http://10.%d.%d.1:8080/svc%d" % ((index >> 8) & 255, index & 255, index))
+        config.set(section, "health_check_url", "http://10.%d.%d.1:8080/health" % ((index >> 8) & 255, index & 255))
+
+    args = Namespace(directory_host="localhost", directory="//localhost/directory")
+    return [watson.read_service(config, section, args) for section in watson.service_sections(config)]
+
+
+def run(options):
+    sherlock = load_sherlock()
+    watson = load_watson()
+    sherlock.log.setLevel(logging.WARNING)
+    watson.log.setLevel(logging.WARNING)
+
+    loop = EventLoop()
+    rundir = tempfile.mkdtemp(prefix="propagation-benchmark-")
+    server = None
+    try:
+        # routes reach the reloader only with snapshots enabled, and they tell which flips a reload completes
+        server = sherlock.Sherlock(make_args(sherlock, ["proxy=%s" % options.proxy] + options.sherlock_set
+                                             + ["snapshot=true"], rundir))
+        services = make_watson_services(watson, options.watson_set, options.services)
+        switches = dict((service.address, Switch(service.service_url)) for service in services)
+        harness = Harness(loop, switches, options.flips, options.interval, options.timeout, options.seed)
+
+        server.reloader = measured_reloader(sherlock, server.reloader, loop, harness)
+        server.reloader.start()
+
+        directory = Directory(loop, options.directory_delay / 1000.0, harness)
+        directory.subscribers.append(server)
+        watson.Tether = directory.tether
+
+        prober = watson.Prober(options.threads, watson.Metrics())
+        prober.injector = Injector(loop, prober)
+        for service in services:
+            prober.watsons.append(watson.Watson(service, switches[service.address], prober))
+        prober.on_reactor_init(Event(None, loop))
+        loop.schedule(options.timeout, WarmUpDeadline(harness))
+
+        started = time.time()
+        loop.run()
+        elapsed = time.time() - started
+    finally:
+        if server is not None:
+            stop_haproxy(server)
+        shutil.rmtree(rundir)
+
+    def stage(name):
+        return percentiles([flip.stages()[name] * 1000.0 for flip in harness.completed])
+
+    return dict(
+        parameters=dict(services=options.services, flips=options.flips, interval=options.interval,
+                        directory_delay_ms=options.directory_delay, proxy=options.proxy, seed=options.seed,
+                        watson_settings=options.watson_set, sherlock_settings=options.sherlock_set),
+        flips=len(harness.completed),
+        timed_out=harness.timed_out,
+        elapsed_seconds=elapsed,
+        propagation_ms=stage("total"),
+        stages_ms=dict((name, stage(name)) for name in ("watson", "directory", "sherlock", "haproxy")),
+        sherlock_metrics=server.metrics.snapshot(),
+    )
+
+
+def main():
+    parser = ArgumentParser(description="Measure how long a change in a service's health takes to reach HAProxy")
+    parser.add_argument("--services", type=int, default=100, help="number of services, one instance each")
+    parser.add_argument("--flips", type=int, default=200, help="number of health flips to measure")
+    parser.add_argument("--interval", type=float, default=0.1, help="seconds between flips")
+    parser.add_argument("--timeout", type=float, default=60, help="seconds after which a flip is given up on")
+    parser.add_argument("--directory-delay", type=float, default=0,
+                        help="milliseconds the directory stand-in takes to pass on a change")
+    parser.add_argument("--threads", type=int, default=4, help="Watson's health check threads")
+    parser.add_argument("--proxy", default="/bin/true", help="the HAProxy executable (default: a stub)")
+    parser.add_argument("--seed", type=int, default=0, help="random seed for the flips")
+    parser.add_argument("--watson-set", action="append", default=[], metavar="KEY=VALUE",
+                        help="override a [Watson] setting, e.g. fast_period=0.2 (repeatable)")
+    parser.add_argument("--sherlock-set", action="append", default=[], metavar="KEY=VALUE",
+                        help="override a [Sherlock] setting, e.g. debounce=1 (repeatable)")
+    parser.add_argument("-o", "--output", metavar="FILE", help="write the JSON results to FILE instead of stdout")
+    options = parser.parse_args()
+
+    results = json.dumps(run(options), indent=2, sort_keys=True)
+    if options.output:
+        with open(options.output, "w") as outf:
+            outf.write(results + "\n")
+    else:
+        print results
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,244 @@
+#!/usr/bin/env python
+
+# Copyright 2015 The Baker Street Authors. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Sherlock benchmark
+
+- Feed Sherlock.on_message a synthetic stream of directory "routes" messages
+- Flush the pending changes the way the debounce timer would, with HAProxy replaced by a stub
+- Report message throughput, update latency, configuration size, reloads and memory use as JSON
+
+Example:
+
+    sherlock_benchmark.py --services 2000 --instances 4 --updates 200 --churn 5 --set runtime_api=true -o out.json
+"""
+
+import imp
+import json
+import logging
+import os
+import random
+import resource
+import shutil
+import sys
+import tempfile
+import time
+
+from argparse import ArgumentParser, Namespace
+from ConfigParser import RawConfigParser
+from StringIO import StringIO
+
+REPO_ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), "..", ".."))
+
+
+def load_sherlock():
+    sys.path.insert(0, REPO_ROOT)
+    return imp.load_source("sherlock", os.path.join(REPO_ROOT, "sherlock"))
+
+
+class StubReactor(object):
+
+    """Accepts the timers Sherlock schedules without ever firing them; the benchmark flushes explicitly"""
+
+    def __init__(self):
+        self.scheduled = 0
+
+    def schedule(self, delay, task):
+        self.scheduled += 1
+        return StubTask()
+
+
+class StubTask(object):
+
+    def cancel(self):
+        pass
+
+
+class StubReloader(object):
+
+    """Stands in for Sherlock's reloader and counts what would have reached HAProxy"""
+
+    def __init__(self):
+        self.reloads = 0
+        self.runtime_updates = 0
+        self.runtime_commands = 0
+        self.config_bytes = 0
+
+    def start(self):
+        pass
+
+    def submit(self, files, commands, reload, routes=None, changes=(), occupants=None):
+        if reload:
+            self.reloads += 1
+        else:
+            self.runtime_updates += 1
+            self.runtime_commands += len(commands)
+        self.config_bytes = sum(len(contents) for contents in files.values())
+
+
+class Message(object):
+
+    subject = "routes"
+
+    def __init__(self, address, targets, policy=None):
+        self.body = [address, [((None, None, target), "benchmark") for target in targets]]
+        self.properties = {"policy": policy}
+
+
+class Event(object):
+
+    def __init__(self, message, reactor):
+        self.message = message
+        self.reactor = reactor
+
+
+class Fleet(object):
+
+    """The synthetic services and the instances of each that are currently up"""
+
+    def __init__(self, services, instances, seed):
+        self.random = random.Random(seed)
+        self.addresses = ["//directory/svc%d" % index for index in range(services)]
+        self.targets = dict((address, ["http://10.%d.%d.%d:8080/svc%d" % ((index >> 8) & 255, index & 255, instance,
+                                                                          index)
+                                       for instance in range(instances)])
+                            for index, address in enumerate(self.addresses))
+        self.down = set()  # (address, target)
+
+    def message(self, address):
+        return Message(address, [target for target in self.targets[address] if (address, target) not in self.down])
+
+    def flap(self):
+
+        """Takes a random instance down or brings it back up and returns the resulting routes message"""
+
+        address = self.random.choice(self.addresses)
+        instance = (address, self.random.choice(self.targets[address]))
+        if instance in self.down:
+            self.down.remove(instance)
+        else:
+            self.down.add(instance)
+        return self.message(address)
+
+
+def percentiles(samples):
+    if not samples:
+        return {}
+    ordered = sorted(samples)
+
+    def rank(fraction):
+        return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+    return dict(p50=rank(0.50), p90=rank(0.90), p99=rank(0.99), max=ordered[-1],
+                mean=sum(ordered) / len(ordered))
+
+
+def make_args(sherlock, overrides, rundir):
+
+    """Builds Sherlock's arguments from its default configuration plus key=value overrides of [Sherlock] settings"""
+
+    config = RawConfigParser()
+    config.readfp(StringIO(sherlock.default_config))
+    for override in overrides:
+        key, _, value = override.partition("=")
+        config.set("Sherlock", key.strip(), value.strip())
+    config.set("Sherlock", "rundir", rundir)
+
+    args = Namespace()
+    sherlock.read_config(config, args)
+    args.directory = "//localhost/directory"
+    return args
+
+
+def run(options):
+    sherlock = load_sherlock()
+    sherlock.log.setLevel(logging.WARNING)
+
+    rundir = tempfile.mkdtemp(prefix="sherlock-benchmark-")
+    try:
+        server = sherlock.Sherlock(make_args(sherlock, options.set, rundir))
+    finally:
+        shutil.rmtree(rundir)
+    reloader = server.reloader = StubReloader()
+    reactor = StubReactor()
+    fleet = Fleet(options.services, options.instances, options.seed)
+
+    # Initial population, as when Sherlock first connects to the directory
+    start = time.time()
+    for address in fleet.addresses:
+        server.on_message(Event(fleet.message(address), reactor))
+    populate_seconds = time.time() - start
+
+    start = time.time()
+    server.update_haproxy()
+    initial_update_seconds = time.time() - start
+
+    # Churn: each update coalesces a batch of instance flaps, as the debounce timer would
+    message_seconds = 0.0
+    update_ms = []
+    for _ in range(options.updates):
+        messages = [fleet.flap() for _ in range(options.churn)]
+        start = time.time()
+        for message in messages:
+            server.on_message(Event(message, reactor))
+        message_seconds += time.time() - start
+
+        start = time.time()
+        server.update_haproxy()
+        update_ms.append((time.time() - start) * 1000.0)
+
+    churn_messages = options.updates * options.churn
+    return dict(
+        sherlock_version=sherlock.__version__,
+        parameters=dict(services=options.services, instances=options.instances, updates=options.updates,
+                        churn=options.churn, seed=options.seed, settings=options.set),
+        populate=dict(messages=len(fleet.addresses),
+                      messages_per_second=len(fleet.addresses) / max(populate_seconds, 1e-9),
+                      update_ms=initial_update_seconds * 1000.0),
+        churn=dict(messages=churn_messages,
+                   messages_per_second=churn_messages / max(message_seconds, 1e-9),
+                   update_ms=percentiles(update_ms)),
+        config_bytes=reloader.config_bytes,
+        reloads=reloader.reloads,
+        runtime_updates=reloader.runtime_updates,
+        runtime_commands=reloader.runtime_commands,
+        timers_scheduled=reactor.scheduled,
+        max_rss_kb=resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+        metrics=server.metrics.snapshot(),
+    )
+
+
+def main():
+    parser = ArgumentParser(description="Benchmark Sherlock against a synthetic directory message stream")
+    parser.add_argument("--services", type=int, default=1000, help="number of services in the directory")
+    parser.add_argument("--instances", type=int, default=3, help="instances per service")
+    parser.add_argument("--updates", type=int, default=100, help="number of debounced updates to apply")
+    parser.add_argument("--churn", type=int, default=10, help="instance flaps coalesced into each update")
+    parser.add_argument("--seed", type=int, default=0, help="random seed for the flaps")
+    parser.add_argument("--set", action="append", default=[], metavar="KEY=VALUE",
+                        help="override a [Sherlock] setting, e.g. runtime_api=true (repeatable)")
+    parser.add_argument("-o", "--output", metavar="FILE", help="write the JSON results to FILE instead of stdout")
+    options = parser.parse_args()
+
+    results = json.dumps(run(options), indent=2, sort_keys=True)
+    if options.output:
+        with open(options.output, "w") as outf:
+            outf.write(results + "\n")
+    else:
+        print results
+
+if __name__ == "__main__":
+    main()
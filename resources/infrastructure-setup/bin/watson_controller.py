@@ -7,8 +7,13 @@ import os
 import subprocess
 import signal
 import atexit
+import shutil
+import tempfile
+import time
 
 from argparse import ArgumentParser
+from ConfigParser import RawConfigParser
+from threading import Lock, Thread, Timer
 from flask import Flask, Response, request
 app = Flask(__name__)
 
@@ -18,30 +23,212 @@ DATAWIRE_CONFIG_ROOT = None
 # path where the Watson executable is located
 WATSON_EXECUTABLE_PATH = None
 
+# default number of configurations checked by each Watson process.
+WATSON_CHECKS_PER_WORKER = 1
+
+# seconds a Watson process is given to exit after SIGTERM before it is killed.
+WATSON_STOP_TIMEOUT = 5
+
+# seconds between checks for Watson processes that have exited.
+REAP_INTERVAL = 1
+
 # dictionary of configurations to Watson PIDs.
 WATSON_INSTANCES = dict()
 
+# dictionary of Watson PIDs to the configurations each of them checks.
+WATSON_WORKERS = dict()
+
+# dictionary of Watson PIDs to the combined configuration written for them, if they check several configurations.
+WATSON_GROUP_CONFIGS = dict()
+
+# dictionary of configurations to their modification time when their Watson was started.
+WATSON_CONFIG_MTIMES = dict()
+
+# PIDs of Watson processes that have been told to stop but not reaped yet.
+STOPPING = set()
+
+# guards the dictionaries above against the reaper thread.
+LOCK = Lock()
+
+# cached index of the known configurations, refreshed when the configuration directory changes.
+CONFIG_INDEX = dict(mtime=None, configs=[])
+
+# directory holding the combined configurations of Watson processes that check several configurations.
+GROUP_CONFIG_DIR = None
+
 def get_known_watson_configs():
-    configs = glob.glob('%s/watson-*.conf' % DATAWIRE_CONFIG_ROOT)
-    return map(lambda s: s.replace("%s/" % DATAWIRE_CONFIG_ROOT, ''), configs)
+    try:
+        mtime = os.stat(DATAWIRE_CONFIG_ROOT).st_mtime
+    except OSError:
+        return []
+    if mtime != CONFIG_INDEX['mtime']:
+        configs = glob.glob('%s/watson-*.conf' % DATAWIRE_CONFIG_ROOT)
+        CONFIG_INDEX['configs'] = sorted(os.path.basename(config) for config in configs)
+        CONFIG_INDEX['mtime'] = mtime
+    return CONFIG_INDEX['configs']
+
+def config_path(config_name):
+    return os.path.join(DATAWIRE_CONFIG_ROOT, config_name)
+
+def config_mtime(config_name):
+    try:
+        return os.stat(config_path(config_name)).st_mtime
+    except OSError:
+        return None
+
+def write_group_config(config_names):
+    """Combines several Watson configurations into one, with a [Watson:<name>] section for each of them"""
+    group = RawConfigParser()
+    for config_name in config_names:
+        config = RawConfigParser()
+        config.read(config_path(config_name))
+        for section in config.sections():
+            target = section
+            if section == 'Watson':
+                target = 'Watson:%s' % config_name[len('watson-'):-len('.conf')]
+            elif group.has_section(section):
+                # settings outside [Watson], such as directory_host, are taken from the first configuration
+                continue
+            group.add_section(target)
+            for option in config.options(section):
+                group.set(target, option, config.get(section, option))
+
+    global GROUP_CONFIG_DIR
+    if GROUP_CONFIG_DIR is None:
+        GROUP_CONFIG_DIR = tempfile.mkdtemp(prefix='watson-controller-')
+    fd, path = tempfile.mkstemp(prefix='group-', suffix='.conf', dir=GROUP_CONFIG_DIR)
+    with os.fdopen(fd, 'w') as outf:
+        group.write(outf)
+    return path
+
+def launch_watson(config_names):
+    if len(config_names) == 1:
+        path = config_path(config_names[0])
+    else:
+        path = write_group_config(config_names)
+
+    proc = subprocess.Popen(["%s" % WATSON_EXECUTABLE_PATH, "-c", path])
+    pid = int(proc.pid)
+    print "loaded %s (pid: %s)" % (", ".join(config_names), pid)
+    with LOCK:
+        WATSON_WORKERS[pid] = list(config_names)
+        if len(config_names) > 1:
+            WATSON_GROUP_CONFIGS[pid] = path
+        for config_name in config_names:
+            WATSON_INSTANCES[config_name] = pid
+            WATSON_CONFIG_MTIMES[config_name] = config_mtime(config_name)
+    return pid
+
+def start_watsons(config_names, per_worker):
+    for index in range(0, len(config_names), per_worker):
+        launch_watson(config_names[index:index + per_worker])
+
+def forget_worker(pid):
+    group_config = WATSON_GROUP_CONFIGS.pop(pid, None)
+    if group_config is not None and os.path.exists(group_config):
+        os.remove(group_config)
+    config_names = WATSON_WORKERS.pop(pid, [])
+    for config_name in config_names:
+        if WATSON_INSTANCES.get(config_name) == pid:
+            WATSON_INSTANCES.pop(config_name, None)
+            WATSON_CONFIG_MTIMES.pop(config_name, None)
+    return config_names
+
+def kill_if_stopping(pid):
+    with LOCK:
+        if pid not in STOPPING:
+            return
+    try:
+        os.kill(pid, signal.SIGKILL)
+    except OSError:
+        pass
 
 def kill_subprocess(pid):
+    """Asks a Watson to stop and kills it if it has not exited in time; the reaper collects its exit status"""
+    with LOCK:
+        config_names = forget_worker(pid)
+        STOPPING.add(pid)
     try:
-        os.kill(int(pid), signal.SIGKILL)
+        os.kill(int(pid), signal.SIGTERM)
     except OSError:
         pass
-    os.waitpid(int(pid), 0)
+    timer = Timer(WATSON_STOP_TIMEOUT, kill_if_stopping, [pid])
+    timer.daemon = True
+    timer.start()
+    return config_names
+
+def restart_workers(config_names, stop):
+    """Restarts every Watson checking one of the configurations, leaving out the ones to stop"""
+    with LOCK:
+        pids = set(WATSON_INSTANCES[name] for name in config_names if name in WATSON_INSTANCES)
+    known = get_known_watson_configs()
+    restarted = []
+    for pid in pids:
+        remaining = [name for name in kill_subprocess(pid) if name in known and not (stop and name in config_names)]
+        if remaining:
+            launch_watson(remaining)
+            restarted.extend(remaining)
+    return restarted
+
+def reap(pid):
+    """Collects the exit status of a Watson that has exited without blocking; returns False if it is still running"""
+    try:
+        reaped, status = os.waitpid(pid, os.WNOHANG)
+    except OSError:
+        # no longer a child of ours, so there is nothing left to wait for
+        reaped, status = pid, None
+    if not reaped:
+        return False
+    with LOCK:
+        STOPPING.discard(pid)
+        config_names = forget_worker(pid)
+    if config_names:
+        app.logger.warning("watson (pid: %s) for %s exited (status: %s)", pid, ", ".join(config_names), status)
+    return True
+
+def reap_children():
+    while True:
+        time.sleep(REAP_INTERVAL)
+        with LOCK:
+            pids = list(WATSON_WORKERS) + list(STOPPING)
+        for pid in pids:
+            reap(pid)
 
 @atexit.register
 def kill_all_watson_instances():
     app.logger.info("Terminating all running watson instances...")
-    for name, pid in WATSON_INSTANCES.iteritems():
+    with LOCK:
+        pids = list(WATSON_WORKERS)
+    for pid in pids:
         kill_subprocess(pid)
-        WATSON_INSTANCES.pop(name, None)
+    deadline = time.time() + WATSON_STOP_TIMEOUT
+    with LOCK:
+        pids = list(STOPPING)
+    for pid in pids:
+        while not reap(pid):
+            if time.time() > deadline:
+                try:
+                    os.kill(pid, signal.SIGKILL)
+                    os.waitpid(pid, 0)
+                except OSError:
+                    pass
+                break
+            time.sleep(0.1)
+    if GROUP_CONFIG_DIR is not None:
+        shutil.rmtree(GROUP_CONFIG_DIR, ignore_errors=True)
+
+def requested_configs(all_configs):
+    """The configurations named by the config_name parameters of a request, or all_configs if it asks for all=true"""
+    if request.args.get('all', '').lower() in ('1', 'yes', 'true', 'on'):
+        return list(all_configs), True
+    return request.args.getlist('config_name'), False
+
+def json_response(body, status=200):
+    return Response(response=json.dumps(body), status=status, mimetype='application/json')
 
 @app.route('/watsons/configs')
 def list_known_watson_configs():
-    return Response(response=json.dumps(get_known_watson_configs()), status=200, mimetype='application/json')
+    return json_response(get_known_watson_configs())
 
 @app.route('/watsons/<name>')
 def get_watson_info(name):
@@ -54,46 +241,57 @@ def get_watson_info(name):
 
 @app.route('/watsons/<name>', methods=['DELETE'])
 def kill_watson(name):
-    pid = WATSON_INSTANCES.get(name, None)
-    if pid is not None:
-        kill_subprocess(pid)
-        WATSON_INSTANCES.pop(name, None)
-
+    restart_workers([name], stop=True)
     return Response(status=200)
 
 @app.route('/watsons', methods=['GET'])
 def show_watsons():
-    return Response(response=json.dumps(dict(WATSON_INSTANCES)), status=200, mimetype='application/json')
+    return json_response(dict(WATSON_INSTANCES))
 
 @app.route('/watsons', methods=['POST'])
 def start_watson():
-    config_name = request.args.get('config_name')
-    if config_name not in get_known_watson_configs():
-        print get_known_watson_configs()
-        print "no config (name: %s)" % config_name
-        return Response(status=400)
-
-    if config_name in WATSON_INSTANCES:
-        print "already loaded"
-        return Response(status=400)
+    known = get_known_watson_configs()
+    config_names, all_configs = requested_configs(known)
+    unknown = [name for name in config_names if name not in known]
+    running = [name for name in config_names if name in WATSON_INSTANCES]
+    for name in unknown:
+        print "no config (name: %s)" % name
+    for name in running:
+        print "already loaded (name: %s)" % name
 
+    started = [name for name in config_names if name in known and name not in WATSON_INSTANCES]
     try:
-        proc = subprocess.Popen(["%s" % WATSON_EXECUTABLE_PATH,
-                                 "-c", "/etc/datawire/%s" % config_name])
-
-        pid = int(proc.pid)
-        print "loaded (pid: %s)" % pid
-        WATSON_INSTANCES[config_name] = int(pid)
-        return Response(status=200)
+        per_worker = max(1, int(request.args.get('per_worker', WATSON_CHECKS_PER_WORKER)))
+        start_watsons(started, per_worker)
     except Exception as e:
         app.logger.error(e)
         return Response(status=500)
 
+    failed = unknown if all_configs else unknown + running
+    return json_response(dict(started=started, unknown=unknown, running=running), status=400 if failed else 200)
+
+@app.route('/watsons', methods=['DELETE'])
+def stop_watsons():
+    config_names, _ = requested_configs(WATSON_INSTANCES)
+    stopped = [name for name in config_names if name in WATSON_INSTANCES]
+    restart_workers(stopped, stop=True)
+    return json_response(dict(stopped=stopped))
+
+@app.route('/watsons/reload', methods=['POST'])
+def reload_watsons():
+    """Restarts the named Watsons, or by default the ones whose configuration changed or disappeared"""
+    config_names, all_configs = requested_configs(WATSON_INSTANCES)
+    if not config_names and not all_configs:
+        config_names = [name for name, mtime in WATSON_CONFIG_MTIMES.items() if config_mtime(name) != mtime]
+    reloaded = restart_workers([name for name in config_names if name in WATSON_INSTANCES], stop=False)
+    return json_response(dict(reloaded=reloaded))
+
 
 @app.route('/info')
 def info():
     return Response(response=json.dumps(dict(datawire_config_root=DATAWIRE_CONFIG_ROOT,
-                                             watson_executable_path=WATSON_EXECUTABLE_PATH)),
+                                             watson_executable_path=WATSON_EXECUTABLE_PATH,
+                                             watson_checks_per_worker=WATSON_CHECKS_PER_WORKER)),
                     status=200,
                     mimetype='application/json')
 
@@ -113,10 +311,16 @@ def main():
     global WATSON_EXECUTABLE_PATH
     WATSON_EXECUTABLE_PATH = config['watson_executable_path']
 
+    global WATSON_CHECKS_PER_WORKER
+    WATSON_CHECKS_PER_WORKER = max(1, int(config.get('watson_checks_per_worker', 1)))
+
+    reaper = Thread(target=reap_children, name="reaper")
+    reaper.daemon = True
+    reaper.start()
+
     app.run(debug=True,
             host=config['watson_controller_listen_address'],
             port=int(config['watson_controller_port']))
 
 if __name__ == "__main__":
     main()
-
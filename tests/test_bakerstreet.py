@@ -6,15 +6,27 @@ def test_resolve_service_with_path(wc_host):
     parameters"""
 
     load_watson_with_config(wc_host, "watson-test_service-path.conf")
-    time.sleep(5)
-    assert requests.get("http://localhost:8000/foo", params=dict(name="Homer")).text == "Hi, Homer!"
+    assert wait_for_route("http://localhost:8000/foo", params=dict(name="Homer")).text == "Hi, Homer!"
 
 def test_resolve_service_without_path(wc_host):
     """Test that Baker Street will route traffic properly"""
 
     load_watson_with_config(wc_host, "watson-test_service-nopath.conf")
-    time.sleep(5)
-    assert requests.get("http://localhost:8000/bar").text == "Hi, everybody!"
+    assert wait_for_route("http://localhost:8000/bar").text == "Hi, everybody!"
 
 def load_watson_with_config(wc_host, config_name):
     resp = requests.post("http://%s/watsons" % wc_host, params=dict(config_name=config_name))
+
+def wait_for_route(url, timeout=30, **kwargs):
+    """Polls the URL until Baker Street routes it, rather than sleeping for a fixed time, and returns the response"""
+
+    deadline = time.time() + timeout
+    while True:
+        try:
+            resp = requests.get(url, **kwargs)
+            if resp.status_code < 500 or time.time() > deadline:
+                return resp
+        except requests.ConnectionError:
+            if time.time() > deadline:
+                raise
+        time.sleep(0.1)
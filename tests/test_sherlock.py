@@ -0,0 +1,720 @@
+import imp
+import json
+import os
+import signal
+import sys
+import time
+import urllib2
+
+from argparse import Namespace
+from ConfigParser import RawConfigParser
+from StringIO import StringIO
+
+import pytest
+
+pytest.importorskip("proton")
+pytest.importorskip("datawire")
+
+REPO_ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), ".."))
+sys.path.insert(0, REPO_ROOT)
+sherlock = imp.load_source("sherlock", os.path.join(REPO_ROOT, "sherlock"))
+
+
+class Reactor(object):
+
+    """Keeps the timers scheduled on it, which run() fires in order against a fake clock"""
+
+    def __init__(self, clock=None):
+        self.clock = clock
+        self.timers = []  # [ (when, task) ]
+
+    def schedule(self, delay, task):
+        self.timers.append(((self.clock() if self.clock else 0) + delay, task))
+        return Task()
+
+    def run(self, until):
+        while self.timers and min(self.timers)[0] <= until:
+            timer = min(self.timers)
+            self.timers.remove(timer)
+            self.clock.now = max(self.clock.now, timer[0])
+            timer[1].on_timer_task(Event(reactor=self))
+        self.clock.now = until
+
+
+class Clock(object):
+
+    def __init__(self, now=1000.0):
+        self.now = now
+
+    def __call__(self):
+        return self.now
+
+
+class Task(object):
+
+    def cancel(self):
+        pass
+
+
+class Message(object):
+
+    subject = "routes"
+
+    def __init__(self, address, targets, policy=None):
+        self.body = [address, [((None, None, target), "test") for target in targets]]
+        self.properties = {"policy": policy}
+
+
+class Event(object):
+
+    def __init__(self, message=None, reactor=None):
+        self.message = message
+        self.reactor = reactor or Reactor()
+
+
+class RecordingReloader(object):
+
+    """Stands in for Sherlock's reloader and keeps every update it is handed"""
+
+    def __init__(self):
+        self.updates = []
+        self.files = {}
+        self.occupants = []
+
+    def submit(self, files, commands, reload, routes=None, changes=(), occupants=None):
+        self.updates.append((list(commands), reload))
+        self.files.update(files)
+        self.occupants.append(occupants)
+
+    def config(self, name="haproxy.conf"):
+        return [contents for path, contents in self.files.items() if os.path.basename(path) == name][0]
+
+
+def make_sherlock(tmpdir, **settings):
+    config = RawConfigParser()
+    config.readfp(StringIO(sherlock.default_config))
+    for key, value in settings.items():
+        config.set("Sherlock", key, str(value))
+    config.set("Sherlock", "rundir", str(tmpdir))
+
+    args = Namespace()
+    sherlock.read_config(config, args)
+    args.directory = "//localhost/directory"
+    server = sherlock.Sherlock(args)
+    server.reloader = RecordingReloader()
+    return server
+
+
+def route(server, service, *targets, **kwargs):
+    server.on_message(Event(Message("//localhost/%s" % service, targets, kwargs.get("policy"))))
+    server.update_haproxy()
+    return server.reloader.updates[-1]
+
+
+def test_slot_reuse_sets_weight(tmpdir):
+    """Test that an instance moved into a slot gets its own weight rather than the one of the slot's last occupant"""
+
+    server = make_sherlock(tmpdir, runtime_api="true", server_slots=4)
+    assert route(server, "svc", "http://10.0.0.1:80/#weight=50", "http://10.0.0.2:80/") == ([], True)
+
+    assert route(server, "svc", "http://10.0.0.2:80/") == (["set server BE_svc/srv1 state maint"], False)
+    assert route(server, "svc", "http://10.0.0.2:80/", "http://10.0.0.3:80/") == ([
+        "set server BE_svc/srv1 addr 10.0.0.3 port 80",
+        "set weight BE_svc/srv1 1",
+        "set server BE_svc/srv1 state ready"], False)
+    assert route(server, "svc", "http://10.0.0.2:80/#weight=20", "http://10.0.0.3:80/") == ([
+        "set weight BE_svc/srv2 20"], False)
+
+
+def test_layout_change_reloads(tmpdir):
+    """Test that only new backends and backends that outgrow their slots restart HAProxy"""
+
+    server = make_sherlock(tmpdir, runtime_api="true", server_slots=2)
+    assert route(server, "svc", "http://10.0.0.1:80/")[1]
+    assert not route(server, "svc", "http://10.0.0.1:80/", "http://10.0.0.2:80/")[1]
+    assert route(server, "svc", "http://10.0.0.1:80/", "http://10.0.0.2:80/", "http://10.0.0.3:80/")[1]
+    assert route(server, "other", "http://10.0.1.1:80/")[1]
+    assert not route(server, "svc")[1]
+    assert route(server, "svc", "http://10.0.0.1:80/", policy="leastconn")[1]
+
+
+def test_policy_parsing():
+    """Test that policies are read from strings and maps"""
+
+    policy = sherlock.RoutePolicy("balance=hdr(X-User), hash_type=map-based, maxconn=10, check=/health, listen=9000")
+    assert policy.balance == "hdr(X-User)"
+    assert policy.hash_type == "map-based"
+    assert policy.maxconn == 10
+    assert policy.check and policy.check_path == "/health"
+    assert policy.listen == ":9000"
+
+    policy = sherlock.RoutePolicy(dict(balance="uri whole depth 2", weights={"10.0.0.1:80": 300}, sni="db.local"))
+    assert policy.balance == "uri whole depth 2"
+    assert policy.hash_type == "consistent"
+    assert policy.weight(("10.0.0.1", 80)) == 256
+    assert policy.weight(("10.0.0.2", 80), 30) == 30
+    assert policy.sni == "db.local"
+
+
+@pytest.mark.parametrize("balance", ["bogus", "url_param", "leastconn ", "roundrobin\n    mode tcp",
+                                     "hdr(X User)", "url_param id\nserver x 10.0.0.1:80", "uri  whole", 5])
+def test_policy_rejects_balance(balance):
+    """Test that a balance setting that does not follow HAProxy's syntax never reaches the configuration"""
+
+    assert sherlock.RoutePolicy(dict(balance=balance)).balance is None
+
+
+@pytest.mark.parametrize("key, value", [("check", "/health now"), ("check", "/health\n    mode tcp"),
+                                        ("check", "health"), ("listen", "70000"), ("listen", "9000\n    bind :1"),
+                                        ("listen", "a b:9000"), ("sni", "a b"), ("sni", "db\n"), ("sni", "a..b")])
+def test_policy_rejects_unsafe_values(key, value):
+    """Test that check paths, listeners and TLS server names that could inject configuration are ignored"""
+
+    policy = sherlock.RoutePolicy({key: value})
+    assert not policy.check and policy.check_path is None
+    assert policy.listen is None
+    assert policy.sni is None
+
+
+@pytest.mark.parametrize("policy", [{u"\xe9": 1}, {"weights": {"h:80": None}}, {"weights": {u"h\xe9:80": 1}},
+                                    {"weights": {"h:80": float("inf")}}, {"maxconn": [1]}, {"maxconn": {}},
+                                    {"timeout_server": float("nan")}, {"slowstart": u"\xe9"}])
+def test_policy_ignores_values_of_the_wrong_type(policy):
+    """Test that a malformed policy map is ignored setting by setting instead of stopping Sherlock"""
+
+    policy = sherlock.RoutePolicy(policy)
+    assert policy.weights == {}
+    assert policy.maxconn is None and policy.timeout_server is None and policy.slowstart is None
+
+
+def test_snapshot_load_and_drop(tmpdir):
+    """Test that snapshot routes are loaded on startup and dropped once the directory does not confirm them"""
+
+    tmpdir.join("routes.json").write(json.dumps(dict(version=sherlock.SNAPSHOT_VERSION, timestamp=time.time(), routes={
+        "//localhost/kept": [["http://10.0.0.1:80/"], None],
+        "//localhost/gone": [["http://10.0.0.2:80/"], None]})))
+    server = make_sherlock(tmpdir, snapshot="true")
+    assert server.load_snapshot()
+    assert server.server_count == 2
+
+    server.on_message(Event(Message("//localhost/kept", ["http://10.0.0.1:80/"])))
+    server.drop_unconfirmed()
+    assert server.route_map["//localhost/kept"][0] == ["http://10.0.0.1:80/"]
+    assert server.route_map["//localhost/gone"][0] == []
+    assert server.server_count == 1
+    assert not server.unconfirmed
+
+
+def test_snapshot_waits_for_a_slow_replay(tmpdir, monkeypatch):
+    """Test that snapshot routes are only dropped once the directory's replay has been quiet for dir_debounce"""
+
+    clock = Clock()
+    monkeypatch.setattr(sherlock, "time", clock)
+    tmpdir.join("routes.json").write(json.dumps(dict(version=sherlock.SNAPSHOT_VERSION, timestamp=clock(), routes={
+        "//localhost/late": [["http://10.0.0.1:80/"], None],
+        "//localhost/gone": [["http://10.0.0.2:80/"], None]})))
+    server = make_sherlock(tmpdir, snapshot="true", dir_debounce=2, dir_max_delay=10)
+    reactor = Reactor(clock)
+    # as on_reactor_init does, without connecting to a directory
+    assert server.load_snapshot()
+    server.update_haproxy()
+    server.timer = reactor.schedule(server.current_debounce, server)
+    server.on_link_remote_open(Event(reactor=reactor))
+
+    # the directory replays one route a second and only gets to the late one after 20 seconds
+    for second in range(1, 20):
+        reactor.run(clock() + 1)
+        server.on_message(Event(Message("//localhost/svc%d" % second, ["http://10.0.1.%d:80/" % second]), reactor))
+    assert server.reloader.updates
+    assert server.route_map["//localhost/late"][0] == ["http://10.0.0.1:80/"]
+    assert server.route_map["//localhost/gone"][0] == ["http://10.0.0.2:80/"]
+
+    reactor.run(clock() + 1)
+    server.on_message(Event(Message("//localhost/late", ["http://10.0.0.1:80/"]), reactor))
+    reactor.run(clock() + 1.5)
+    assert server.route_map["//localhost/gone"][0] == ["http://10.0.0.2:80/"]
+    reactor.run(clock() + 1)
+    assert server.route_map["//localhost/late"][0] == ["http://10.0.0.1:80/"]
+    assert server.route_map["//localhost/gone"][0] == []
+    assert not server.reconciling
+    assert "10.0.0.2" not in server.reloader.config("paths.map") + server.reloader.config()
+
+
+def test_snapshot_of_unknown_version_is_ignored(tmpdir):
+    tmpdir.join("routes.json").write(json.dumps(dict(version=-1, timestamp=time.time(), routes={})))
+    assert not make_sherlock(tmpdir, snapshot="true").load_snapshot()
+
+
+def test_server_state_of_reused_slots_is_dropped(tmpdir):
+    """Test that the saved state of a slot only survives a restart if the slot keeps its instance"""
+
+    header = "# be_id be_name srv_id srv_name srv_addr srv_op_state srv_admin_state srv_uweight srv_port"
+    state = "\n".join(["1", header,
+                       "3 BE_svc 1 srv1 10.0.0.1 0 0 5 80",
+                       "3 BE_svc 2 srv2 10.0.0.2 0 0 5 80",
+                       "3 BE_svc 3 srv3 10.0.0.3 0 0 5 80",
+                       "4 BE_other 1 10.0.1.1_80 10.0.1.1 0 0 5 80"])
+    occupants = {("BE_svc", "srv1"): ("10.0.0.1", 80), ("BE_svc", "srv2"): ("10.0.0.4", 80),
+                 ("BE_svc", "srv3"): None}
+
+    reloader = sherlock.Reloader(None, None, None, None, None, str(tmpdir.join("haproxy.state")), None, None)
+    assert reloader.filter_server_state(state, occupants).splitlines() == [
+        "1", header, "3 BE_svc 1 srv1 10.0.0.1 0 0 5 80", "4 BE_other 1 10.0.1.1_80 10.0.1.1 0 0 5 80"]
+
+
+def test_slot_occupants_of_changed_backends(tmpdir):
+    """Test that the reloader is told who is in the slots of the backends an update changed, and only then"""
+
+    server = make_sherlock(tmpdir, runtime_api="true", server_slots=2, server_state="true")
+    route(server, "svc", "http://10.0.0.1:80/")
+    route(server, "other", "http://10.0.1.1:80/")
+    assert server.reloader.occupants[-1] == {("BE_other", "srv1"): ("10.0.1.1", 80), ("BE_other", "srv2"): None}
+    route(server, "svc")
+    assert server.reloader.occupants[-1] == {("BE_svc", "srv1"): None, ("BE_svc", "srv2"): None}
+
+    server = make_sherlock(tmpdir, runtime_api="true", server_slots=2)
+    route(server, "svc", "http://10.0.0.1:80/")
+    assert server.reloader.occupants == [None]
+
+
+def test_coalesced_slot_occupants():
+    reloader = sherlock.Reloader(None, None, None, None, None, None, None, None)
+    reloader.submit({}, ["a"], False, occupants={("BE_a", "srv1"): ("10.0.0.1", 80), ("BE_a", "srv2"): None})
+    reloader.submit({}, ["b"], False)
+    reloader.submit({}, [], True, occupants={("BE_a", "srv2"): ("10.0.0.2", 80), ("BE_b", "srv1"): None})
+    assert reloader.pending[5] == {("BE_a", "srv1"): ("10.0.0.1", 80), ("BE_a", "srv2"): ("10.0.0.2", 80),
+                                   ("BE_b", "srv1"): None}
+    assert reloader.pending[1:3] == [["a", "b"], True]
+
+
+def test_runtime_resolves_hostnames():
+    runtime = sherlock.HAProxyRuntime(None)
+    assert runtime.resolve("set server BE_svc/srv1 addr localhost port 80") == \
+        "set server BE_svc/srv1 addr 127.0.0.1 port 80"
+    assert runtime.resolve("set server BE_svc/srv1 addr ::1 port 80") == "set server BE_svc/srv1 addr ::1 port 80"
+    assert runtime.resolve("set weight BE_svc/srv1 5") == "set weight BE_svc/srv1 5"
+
+
+def test_runtime_rejections():
+    """Test that any rejected command fails the update, including weights a static algorithm cannot take"""
+
+    runtime = sherlock.HAProxyRuntime(None)
+    for reply, accepted in [("\n\n", True), ("No such server.\n", False), ("Invalid weight\n", False),
+                            ("\nBackend is using a static LB algorithm and only accepts weights '0%' and '100%'.\n",
+                             False)]:
+        runtime.query = lambda command: reply
+        assert runtime.execute(["set server BE_svc/srv1 state ready", "set weight BE_svc/srv1 20"]) == accepted
+
+
+def test_rejected_runtime_update_restarts(tmpdir, monkeypatch):
+    class Runtime(object):
+        def execute(self, commands):
+            return False
+
+    reloader = sherlock.Reloader(None, None, Runtime(), sherlock.Metrics(), None, None, None, None)
+    restarts = []
+    monkeypatch.setattr(reloader, "reload_haproxy", lambda occupants=None: restarts.append(occupants) or True)
+    path = str(tmpdir.join("haproxy.conf"))
+    assert reloader.apply({path: "global"}, ["set weight BE_svc/srv1 20"], False)
+    assert restarts == [None]
+    assert "global" in open(path).read()
+    assert reloader.metrics.counters["runtime_updates_failed"] == 1
+
+
+def test_write_atomically_keeps_permissions(tmpdir):
+    """Test that replaced files keep their mode and new ones get the mode open() would give them"""
+
+    path = str(tmpdir.join("haproxy.conf"))
+    umask = os.umask(0o022)
+    try:
+        sherlock.write_atomically(path, "global")
+        assert os.stat(path).st_mode & 0o777 == 0o644
+        os.chmod(path, 0o640)
+        sherlock.write_atomically(path, "defaults")
+        assert os.stat(path).st_mode & 0o777 == 0o640
+    finally:
+        os.umask(umask)
+    assert open(path).read() == "defaults"
+    assert tmpdir.listdir() == [tmpdir.join("haproxy.conf")]
+
+
+def test_token_bucket():
+    """Test that a burst of events is allowed at once and later ones are spaced out by the interval"""
+
+    bucket = sherlock.TokenBucket(10, 2)
+    bucket.take()
+    assert bucket.delay() == 0
+    bucket.take()
+    assert 9 < bucket.delay() <= 10
+    bucket.updated -= 5
+    assert 4 < bucket.delay() <= 5
+
+    unlimited = sherlock.TokenBucket(0, 1)
+    for _ in range(5):
+        unlimited.take()
+    assert unlimited.delay() == 0
+
+
+def test_draining_processes(monkeypatch):
+    """Test that the oldest generations are stopped once too many are draining or they drain for too long"""
+
+    killed = []
+    monkeypatch.setattr(sherlock, "process_running", lambda pid: pid not in killed)
+    monkeypatch.setattr(os, "kill", lambda pid, sig: killed.append(pid) if sig == signal.SIGTERM else None)
+
+    draining = sherlock.DrainingProcesses(2, 300, sherlock.Metrics())
+    draining.add([101])
+    draining.add([102, 103])
+    draining.add([102, 103])
+    assert killed == []
+    draining.add([104])
+    assert killed == [101]
+    assert [pids for _, pids in draining.generations] == [[102, 103], [104]]
+
+    draining.generations[0] = (time.time() - 300, [102, 103])
+    assert draining.reap() <= draining.check_interval
+    assert killed == [101, 102, 103]
+    assert [pids for _, pids in draining.generations] == [[104]]
+
+
+def test_header_defaults(tmpdir):
+    """Test that the connection settings are rendered with their defaults and nothing optional is added"""
+
+    server = make_sherlock(tmpdir)
+    route(server, "svc", "http://10.0.0.1:80/")
+    config = server.reloader.config().split("\n")
+    for line in ["    maxconn 256", "    timeout connect 5000ms", "    timeout client 50000ms",
+                 "    timeout server 50000ms", "    bind *:8000", "    server 10.0.0.1_80 10.0.0.1:80 maxconn 32"]:
+        assert line in config
+    for prefix in ["    nbproc", "    nbthread", "    timeout queue", "    timeout http-keep-alive", "    option http",
+                   "    http-reuse"]:
+        assert not [line for line in config if line.startswith(prefix)]
+
+
+def test_header_settings(tmpdir):
+    server = make_sherlock(tmpdir, maxconn=1000, nbthread=4, timeout_queue=1000, timeout_http_keep_alive=500,
+                           keep_alive="server-close", http_reuse="safe", server_maxconn=64)
+    route(server, "svc", "http://10.0.0.1:80/")
+    config = server.reloader.config().split("\n")
+    for line in ["    maxconn 1000", "    nbthread 4", "    timeout queue 1000ms", "    timeout http-keep-alive 500ms",
+                 "    option http-server-close", "    http-reuse safe",
+                 "    server 10.0.0.1_80 10.0.0.1:80 maxconn 64"]:
+        assert line in config
+
+
+def test_invalid_header_settings_are_refused(tmpdir):
+    with pytest.raises(ValueError):
+        make_sherlock(tmpdir, keep_alive="sometimes")
+    with pytest.raises(ValueError):
+        make_sherlock(tmpdir, http_reuse="often")
+
+
+def test_policy_overrides_connection_settings(tmpdir):
+    """Test that a service's policy overrides the connection settings of its own backend only"""
+
+    server = make_sherlock(tmpdir)
+    route(server, "other", "http://10.0.1.1:80/")
+    route(server, "svc", "http://10.0.0.1:80/",
+          policy="maxconn=10, timeout_connect=100, timeout_server=2000, timeout_queue=300, keep_alive=close, "
+                 "http_reuse=always")
+    backends = server.reloader.config().split("\nbackend ")
+    svc = [backend for backend in backends if backend.startswith("BE_svc")][0].split("\n")
+    other = [backend for backend in backends if backend.startswith("BE_other")][0].split("\n")
+    for line in ["    timeout connect 100ms", "    timeout server 2000ms", "    timeout queue 300ms",
+                 "    option httpclose", "    http-reuse always", "    server 10.0.0.1_80 10.0.0.1:80 maxconn 10"]:
+        assert line in svc
+    assert "    server 10.0.1.1_80 10.0.1.1:80 maxconn 32" in other
+    assert not [line for line in other if line.startswith(("    timeout", "    option", "    http-reuse"))]
+
+
+@pytest.mark.parametrize("policy", [{"keep_alive": ["close"]}, {"keep_alive": {"close": 1}}, {"keep_alive": "open"},
+                                    {"http_reuse": ["safe"]}, {"observe": {}}, {"on_error": ["mark-down"]}])
+def test_policy_ignores_unknown_choices(policy):
+    policy = sherlock.RoutePolicy(policy)
+    assert policy.keep_alive is None and policy.http_reuse is None
+    assert policy.observe is None and policy.on_error is None
+
+
+def test_only_changed_services_are_rendered(tmpdir, monkeypatch):
+    """Test that an update re-renders only the services it touched and ends up with the same configuration"""
+
+    server = make_sherlock(tmpdir)
+    route(server, "a", "http://10.0.0.1:80/")
+    route(server, "b", "http://10.0.0.2:80/")
+    route(server, "c", "http://10.0.0.3:80/")
+
+    rendered = []
+    render_service = server.render_service
+    monkeypatch.setattr(server, "render_service",
+                        lambda address: rendered.append(address) or render_service(address))
+    route(server, "b", "http://10.0.0.2:80/", "http://10.0.0.4:80/")
+    route(server, "a")
+    assert rendered == ["//localhost/b", "//localhost/a"]
+
+    fresh = make_sherlock(tmpdir)
+    route(fresh, "b", "http://10.0.0.2:80/", "http://10.0.0.4:80/")
+    route(fresh, "c", "http://10.0.0.3:80/")
+    assert server.reloader.config() == fresh.reloader.config()
+    assert server.reloader.config("paths.map") == fresh.reloader.config("paths.map") == \
+        "/b BE_b\n/c BE_c"
+
+
+def test_unchanged_updates_are_suppressed(tmpdir):
+    """Test that routes that leave the configuration as it is never reach the reloader"""
+
+    server = make_sherlock(tmpdir)
+    route(server, "svc", "http://10.0.0.1:80/", "http://10.0.0.2:80/")
+    assert len(server.reloader.updates) == 1
+
+    route(server, "svc", "http://10.0.0.1:80/", "http://10.0.0.2:80/")
+    assert server.metrics.counters["messages_unchanged"] == 1
+    # a different order of the same instances is a different message, but renders the same configuration
+    route(server, "svc", "http://10.0.0.2:80/", "http://10.0.0.1:80/")
+    assert len(server.reloader.updates) == 1
+    assert server.metrics.counters["renders_suppressed"] == 2
+
+
+def test_single_timer_with_max_delay(tmpdir, monkeypatch):
+    """Test that constant churn is flushed every max_delay through a single timer, and quiet is flushed on debounce"""
+
+    clock = Clock()
+    monkeypatch.setattr(sherlock, "time", clock)
+    server = make_sherlock(tmpdir, debounce=2, max_delay=10)
+    reactor = Reactor(clock)
+    server.timer = reactor.schedule(server.current_debounce, server)
+    flushes = []
+    update_haproxy = server.update_haproxy
+    monkeypatch.setattr(server, "update_haproxy", lambda: flushes.append(clock() - 1000) or update_haproxy())
+
+    reactor.run(1002)
+    assert flushes == [2]
+    for second in range(3, 33):
+        reactor.run(1000 + second)
+        server.on_message(Event(Message("//localhost/svc", ["http://10.0.0.%d:80/" % second]), reactor))
+        assert len(reactor.timers) == 1
+    assert flushes == [2, 13, 23]
+    reactor.run(1040)
+    assert flushes == [2, 13, 23, 33]
+    assert reactor.timers == []
+
+    reactor.run(1050)
+    server.on_message(Event(Message("//localhost/svc", ["http://10.0.0.50:80/"]), reactor))
+    reactor.run(1060)
+    assert flushes == [2, 13, 23, 33, 52]
+    assert server.reloader.config("paths.map") == "/svc BE_svc"
+    assert "    server 10.0.0.50_80 10.0.0.50:80 maxconn 32" in server.reloader.config().split("\n")
+
+
+def test_path_map(tmpdir):
+    """Test that with path_map every service is a line of the map file and a single rule routes all of them"""
+
+    server = make_sherlock(tmpdir)
+    route(server, "b", "http://10.0.0.2:80/")
+    route(server, "a", "http://10.0.0.1:80/api")
+    config = server.reloader.config().split("\n")
+    assert [line for line in config if "use_backend" in line or "acl" in line] == [
+        "    use_backend %%[path,map_beg(%s)]" % tmpdir.join("paths.map")]
+    assert server.reloader.config("paths.map") == "/a BE_a\n/b BE_b"
+    assert "    reqrep ^([^\\ :]*)\\ /a(.*) \\1\\ /api\\2" in config
+
+    route(server, "b")
+    assert server.reloader.config("paths.map") == "/a BE_a"
+
+
+def test_acl_per_service(tmpdir):
+    server = make_sherlock(tmpdir, path_map="false")
+    route(server, "b", "http://10.0.0.2:80/")
+    route(server, "a", "http://10.0.0.1:80/")
+    config = server.reloader.config().split("\n")
+    assert [line for line in config if "use_backend" in line or "acl" in line] == [
+        "    acl IS_a path_beg /a", "    use_backend BE_a if IS_a",
+        "    acl IS_b path_beg /b", "    use_backend BE_b if IS_b"]
+    assert "paths.map" not in [os.path.basename(path) for path in server.reloader.files]
+
+
+def test_metrics_snapshot():
+    metrics = sherlock.Metrics()
+    metrics.increment("reloads_attempted")
+    metrics.increment("reloads_attempted")
+    metrics.increment("messages_received", "//localhost/svc")
+    metrics.increment("snapshot_addresses_dropped", amount=3)
+    metrics.set("servers", 4)
+    metrics.observe("render_seconds", 0.003)
+    metrics.observe("render_seconds", 2)
+
+    snapshot = metrics.snapshot()
+    assert snapshot["counters"] == {"reloads_attempted": 2, "messages_received": {"//localhost/svc": 1},
+                                    "snapshot_addresses_dropped": 3}
+    assert snapshot["gauges"] == {"servers": 4}
+    histogram = snapshot["histograms"]["render_seconds"]
+    assert histogram["count"] == 2 and histogram["sum"] == 2.003
+    assert histogram["buckets"]["0.001"] == 0 and histogram["buckets"]["0.005"] == 1
+    assert histogram["buckets"]["2"] == 2 and histogram["buckets"]["+Inf"] == 2
+
+    # a snapshot is a copy, not a view of the live counters
+    metrics.increment("messages_received", "//localhost/svc")
+    assert snapshot["counters"]["messages_received"] == {"//localhost/svc": 1}
+
+
+def test_pipeline_metrics(tmpdir):
+    """Test that routing updates the counters, gauges and histograms served at the metrics endpoint"""
+
+    server = make_sherlock(tmpdir)
+    route(server, "a", "http://10.0.0.1:80/", "http://10.0.0.2:80/")
+    route(server, "b", "http://10.0.1.1:80/")
+    route(server, "b", "http://10.0.1.1:80/")
+
+    metrics = sherlock.MetricsServer(server.metrics, "127.0.0.1", 0)
+    metrics.start()
+    snapshot = json.loads(urllib2.urlopen("http://127.0.0.1:%d/" % metrics.httpd.server_port).read())
+    assert snapshot["counters"]["messages_received"] == {"//localhost/a": 1, "//localhost/b": 2}
+    assert snapshot["counters"]["messages_unchanged"] == 1
+    assert snapshot["gauges"] == {"services": 2, "servers": 3}
+    assert snapshot["histograms"]["render_seconds"]["count"] == 2
+    metrics.httpd.shutdown()
+
+
+def test_check_rendering(tmpdir):
+    """Test that a policy's health check and error observation settings end up on the backend and its servers"""
+
+    server = make_sherlock(tmpdir)
+    route(server, "svc", "http://10.0.0.1:80/", policy="check=/health?full=1, check_interval=1000, rise=2, fall=3, "
+                                                       "observe=layer7, error_limit=5, on_error=mark-down")
+    config = server.reloader.config().split("\n")
+    assert "    option httpchk GET /health?full=1" in config
+    assert ("    server 10.0.0.1_80 10.0.0.1:80 maxconn 32 check inter 1000ms rise 2 fall 3 observe layer7 "
+            "error-limit 5 on-error mark-down") in config
+
+    route(server, "svc", "http://10.0.0.1:80/", policy="observe=layer4")
+    config = server.reloader.config().split("\n")
+    assert "    server 10.0.0.1_80 10.0.0.1:80 maxconn 32 check observe layer4" in config
+    assert not [line for line in config if "httpchk" in line]
+
+    route(server, "svc", "http://10.0.0.1:80/", policy="check=true")
+    assert "    server 10.0.0.1_80 10.0.0.1:80 maxconn 32 check" in server.reloader.config().split("\n")
+    route(server, "svc", "http://10.0.0.1:80/")
+    assert "    server 10.0.0.1_80 10.0.0.1:80 maxconn 32" in server.reloader.config().split("\n")
+
+
+def test_check_rendering_in_slots(tmpdir):
+    server = make_sherlock(tmpdir, runtime_api="true", server_slots=2)
+    route(server, "svc", "http://10.0.0.1:80/", policy="check=true, check_interval=500")
+    config = server.reloader.config().split("\n")
+    assert "    server srv1 10.0.0.1:80 maxconn 32 check inter 500ms" in config
+    assert "    server srv2 127.0.0.1:1 maxconn 32 check inter 500ms disabled" in config
+
+
+def test_service_filter(tmpdir):
+    """Test that only services matching one of the configured patterns are routed"""
+
+    server = make_sherlock(tmpdir, services="web-*, api")
+    for service in ("web-1", "api", "api2", "db"):
+        server.on_message(Event(Message("//localhost/%s" % service, ["http://10.0.0.1:80/"])))
+    assert sorted(server.route_map) == ["//localhost/api", "//localhost/web-1"]
+    assert server.metrics.counters["messages_filtered"] == 2
+    assert not server.parked
+
+
+def test_learning_parks_and_learns(tmpdir):
+    """Test that an untracked service is parked while learning and routed as soon as it is asked for"""
+
+    server = make_sherlock(tmpdir, services="web", learn_services="true")
+    try:
+        route(server, "web", "http://10.0.0.1:80/")
+        config = server.reloader.config().split("\n")
+        assert "    default_backend sherlock-learn" in config
+        assert "    server learn 127.0.0.1:%d" % server.learning_server.port in config
+
+        server.on_message(Event(Message("//localhost/svc", ["http://10.0.0.2:80/"])))
+        server.on_message(Event(Message("//localhost/gone", ["http://10.0.0.3:80/"])))
+        server.on_message(Event(Message("//localhost/gone", [])))
+        assert server.parked == {"//localhost/svc": (["http://10.0.0.2:80/"], None)}
+        assert "//localhost/svc" not in server.route_map
+
+        server.requested = set(["svc", "unknown"])
+        server.on_services_requested(Event())
+        assert server.route_map["//localhost/svc"] == (["http://10.0.0.2:80/"], None)
+        assert server.learned == set(["svc"])
+        assert not server.parked and not server.requested
+        assert server.metrics.counters["services_learned"] == 1
+
+        route(server, "svc", "http://10.0.0.4:80/")
+        assert server.route_map["//localhost/svc"] == (["http://10.0.0.4:80/"], None)
+        assert "BE_svc" in server.reloader.config()
+    finally:
+        server.learning_server.httpd.server_close()
+
+
+def test_learning_server_reports_requests(tmpdir):
+    server = make_sherlock(tmpdir, learn_services="true")
+    server.learning_server.start()
+    try:
+        with pytest.raises(urllib2.HTTPError) as exc:
+            urllib2.urlopen("http://127.0.0.1:%d/svc/some/path" % server.learning_server.port, timeout=5)
+        assert exc.value.code == 503
+        assert server.requested == set(["svc"])
+    finally:
+        server.learning_server.httpd.shutdown()
+        server.learning_server.httpd.server_close()
+
+
+@pytest.mark.parametrize("learn_services, routed", [("false", ["//localhost/web"]),
+                                                    ("true", ["//localhost/svc", "//localhost/web"])])
+def test_snapshot_of_untracked_services(tmpdir, learn_services, routed):
+    """Test that untracked services in the snapshot are dropped, unless learning, as they must have been asked for"""
+
+    tmpdir.join("routes.json").write(json.dumps(dict(version=sherlock.SNAPSHOT_VERSION, timestamp=time.time(), routes={
+        "//localhost/web": [["http://10.0.0.1:80/"], None],
+        "//localhost/svc": [["http://10.0.0.2:80/"], None]})))
+    server = make_sherlock(tmpdir, snapshot="true", services="web", learn_services=learn_services)
+    try:
+        assert server.load_snapshot()
+        assert sorted(server.route_map) == routed
+        assert server.tracks("//localhost/svc") == (learn_services == "true")
+    finally:
+        if server.learning_server:
+            server.learning_server.httpd.server_close()
+
+
+def test_tcp_listener(tmpdir):
+    """Test that a TCP service with a listen port gets a frontend of its own and no part in the HTTP frontend"""
+
+    server = make_sherlock(tmpdir, path_map="false")
+    route(server, "db", "tcp://10.0.0.1:5432", policy="listen=9000")
+    config = server.reloader.config()
+    assert ("\nfrontend FE_db\n    mode tcp\n    bind :9000\n    default_backend BE_db\n"
+            "\nbackend BE_db\n    mode tcp\n") in config
+    assert "    server 10.0.0.1_5432 10.0.0.1:5432 maxconn 32" in config.split("\n")
+    assert "IS_db" not in config and "reqrep" not in config and "tcp-in" not in config
+
+    route(server, "db", "tcp://10.0.0.1:5432", policy="listen=127.0.0.1:9001")
+    assert "    bind 127.0.0.1:9001" in server.reloader.config().split("\n")
+
+
+def test_tcp_sni_rules(tmpdir):
+    """Test that TCP services without a listen port are routed by TLS server name when tcp_bind is set"""
+
+    server = make_sherlock(tmpdir, tcp_bind=":8443")
+    route(server, "db.example.com", "tcp://10.0.0.1:5432")
+    route(server, "cache", "tcp://10.0.0.2:6379", policy="sni=cache.example.com")
+    route(server, "queue+1", "tcp://10.0.0.3:5672")
+    config = server.reloader.config()
+    lines = config.split("\n")
+    tcp_in = lines.index("frontend tcp-in")
+    assert lines[tcp_in:tcp_in + 5] == [
+        "frontend tcp-in", "    mode tcp", "    bind :8443", "    tcp-request inspect-delay 5s",
+        "    tcp-request content accept if { req_ssl_hello_type 1 }"]
+    assert sorted(lines[tcp_in + 5:]) == [
+        "    use_backend BE_cache if { req_ssl_sni -i cache.example.com }",
+        "    use_backend BE_db.example.com if { req_ssl_sni -i db.example.com }"]
+    assert "BE_queue+1" not in config
+    assert server.reloader.config("paths.map") == ""
+
+
+def test_tcp_service_without_listener_is_not_routed(tmpdir):
+    server = make_sherlock(tmpdir)
+    route(server, "db", "tcp://10.0.0.1:5432")
+    route(server, "web", "http://10.0.0.2:80/")
+    config = server.reloader.config()
+    assert "BE_db" not in config and "tcp-in" not in config
+    assert "backend BE_web" in config
@@ -0,0 +1,431 @@
+import imp
+import os
+import socket
+import sys
+import threading
+import time
+
+from argparse import Namespace
+from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+from ConfigParser import RawConfigParser
+from SocketServer import ThreadingMixIn
+from StringIO import StringIO
+
+import pytest
+
+pytest.importorskip("proton")
+pytest.importorskip("datawire")
+
+REPO_ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), ".."))
+sys.path.insert(0, REPO_ROOT)
+watson = imp.load_source("watson", os.path.join(REPO_ROOT, "watson"))
+
+
+class Reactor(object):
+
+    def __init__(self):
+        self.delays = []
+
+    def schedule(self, delay, task):
+        self.delays.append(delay)
+
+
+class Event(object):
+
+    def __init__(self):
+        self.reactor = Reactor()
+
+
+class Tether(object):
+
+    """Stands in for the directory tether and records the targets the service is registered with"""
+
+    registered = []
+
+    def __init__(self, directory, address, target, **kwargs):
+        self.target = target
+
+    def start(self, reactor):
+        Tether.registered.append(self.target)
+
+    def stop(self, reactor):
+        Tether.registered.remove(self.target)
+
+
+class Liveness(object):
+
+    url = "http://localhost:9000/health"
+    load = None
+    cause = None
+
+
+class Prober(object):
+
+    def __init__(self):
+        self.metrics = watson.Metrics()
+
+
+class HealthHandler(BaseHTTPRequestHandler):
+
+    """Answers health checks as the test server is told to, keeping connections open unless told to drop them"""
+
+    protocol_version = "HTTP/1.1"
+
+    def do_GET(self):
+        self.server.requests.append(self.client_address)
+        time.sleep(self.server.delay)
+        self.send_response(self.server.status)
+        self.send_header("Content-Length", str(len(self.server.body)))
+        self.send_header("X-Load", "0.25")
+        self.end_headers()
+        if self.command != "HEAD":
+            self.wfile.write(self.server.body)
+        # drop the connection without saying so, as a service timing out an idle keep-alive connection would
+        self.close_connection = self.server.drop
+
+    do_HEAD = do_GET
+
+    def log_message(self, format, *args):
+        pass
+
+
+class HealthServer(ThreadingMixIn, HTTPServer):
+
+    daemon_threads = True
+
+    def __init__(self):
+        HTTPServer.__init__(self, ("127.0.0.1", 0), HealthHandler)
+        self.requests = []  # client address of every request
+        self.delay = 0
+        self.status = 200
+        self.body = "OK"
+        self.drop = False
+        self.url = "http://127.0.0.1:%d/health" % self.server_address[1]
+
+    def handle_error(self, request, client_address):
+        # the probes under test abandon connections on purpose
+        pass
+
+
+@pytest.fixture
+def health_server():
+    server = HealthServer()
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+def make_watson(monkeypatch, **settings):
+    monkeypatch.setattr(watson, "Tether", Tether)
+    monkeypatch.setattr(Tether, "registered", [])
+
+    config = RawConfigParser()
+    config.readfp(StringIO(watson.default_config))
+    config.set("Watson", "service_name", "svc")
+    config.set("Watson", "service_url", "http://localhost:9000")
+    config.set("Watson", "health_check_url", "http://localhost:9000/health")
+    config.set("Watson", "jitter", "0")
+    for key, value in settings.items():
+        config.set("Watson", key, str(value))
+
+    service = watson.read_service(config, "Watson", Namespace(directory="//localhost/directory",
+                                                              directory_host="localhost"))
+    return watson.Watson(service, Liveness(), Prober())
+
+
+def probe(service, *results):
+    event = Event()
+    for alive in results:
+        service.on_probe_result(alive, 0.01, None if alive else "refused", event)
+    return event.reactor.delays
+
+
+def test_status_codes():
+    assert watson.status_codes("200") == set([200])
+    assert watson.status_codes("200-204, 301") == set([200, 201, 202, 203, 204, 301])
+
+
+def test_rise_and_fall(monkeypatch):
+    """Test that a service is only registered after rise passing checks and removed after fall failing ones"""
+
+    service = make_watson(monkeypatch, rise=2, fall=3)
+    probe(service, True)
+    assert Tether.registered == []
+    probe(service, True)
+    assert Tether.registered == ["http://localhost:9000"]
+
+    probe(service, False, False, True, False, False)
+    assert Tether.registered == ["http://localhost:9000"]
+    probe(service, False)
+    assert Tether.registered == []
+
+
+def test_scheduling(monkeypatch):
+    """Test that checks back off while they agree with the state and speed up when they disagree"""
+
+    service = make_watson(monkeypatch, rise=2, fall=2, period=3, fast_period=1, max_period=12)
+    assert probe(service, True, True, True, True, True) == [1, 3, 6, 12, 12]
+    assert probe(service, False, True) == [1, 3]
+
+
+def test_trace_changes(monkeypatch):
+    service = make_watson(monkeypatch, rise=1, fall=1, trace_changes="true", flap_half_life=0)
+    probe(service, True, False, True)
+    assert len(Tether.registered) == 1
+    assert Tether.registered[0].startswith("http://localhost:9000#change=3&ts=")
+
+
+def test_flap_damping(monkeypatch):
+    """Test that a service that keeps flapping is held out of rotation until its flaps have decayed"""
+
+    service = make_watson(monkeypatch, rise=1, fall=1, flap_half_life=60, flap_limit=2)
+    probe(service, True, False, True, False, True, False, True)
+    assert Tether.registered == []
+    assert service.held
+
+    service.damping.updated -= 120
+    probe(service, True)
+    assert Tether.registered == ["http://localhost:9000"]
+    assert not service.held
+
+
+def test_flap_damping_decay():
+    damping = watson.FlapDamping(60, 2)
+    damping.flap()
+    assert not damping.suppressed()
+    damping.flap()
+    damping.flap()
+    assert damping.suppressed()
+    damping.updated -= 30
+    assert damping.suppressed()
+    damping.updated -= 90
+    assert not damping.suppressed()
+
+    disabled = watson.FlapDamping(0, 1)
+    for _ in range(5):
+        disabled.flap()
+    assert not disabled.suppressed()
+
+
+def test_service_sections_fall_back_to_watson():
+    """Test that [Watson:<name>] sections describe a service each, with settings they lack taken from [Watson]"""
+
+    config = RawConfigParser()
+    config.readfp(StringIO(watson.default_config))
+    config.set("Watson", "period", "5")
+    config.set("Watson", "health_check_url", "http://localhost:9000/health")
+    config.add_section("Watson:api")
+    config.set("Watson:api", "service_url", "http://localhost:9001")
+    config.set("Watson:api", "rise", "1")
+    config.add_section("Watson:web")
+    config.set("Watson:web", "service_name", "frontend")
+    config.set("Watson:web", "service_url", "http://localhost:9002")
+    config.set("Watson:web", "health_check_url", "http://localhost:9002/health")
+    assert watson.service_sections(config) == ["Watson:api", "Watson:web"]
+
+    args = Namespace(directory="//localhost/directory", directory_host="localhost")
+    api = watson.read_service(config, "Watson:api", args)
+    assert (api.service_name, api.address, api.service_url) == ("api", "//localhost/api", "http://localhost:9001")
+    assert (api.rise, api.period, api.health_check_url) == (1, 5, "http://localhost:9000/health")
+    web = watson.read_service(config, "Watson:web", args)
+    assert (web.service_name, web.address, web.health_check_url) == ("frontend", "//localhost/frontend",
+                                                                     "http://localhost:9002/health")
+    assert (web.rise, web.period) == (2, 5)
+
+    config.set("Watson", "service_name", "svc")
+    config.set("Watson", "service_url", "http://localhost:9000")
+    assert watson.service_sections(config) == ["Watson", "Watson:api", "Watson:web"]
+    assert watson.read_service(config, "Watson", args).service_name == "svc"
+    assert watson.read_service(config, "Watson:api", args).service_name == "api"
+
+
+def test_http_probe_keeps_the_connection(health_server):
+    """Test that HTTP checks reuse their connection and retry once on a new one if the service dropped it"""
+
+    liveness = watson.LivenessByHTTPGet(health_server.url, load_header="X-Load", pattern="^OK$")
+    assert liveness() and liveness()
+    assert liveness.load == 0.25
+    assert len(set(health_server.requests)) == 1
+
+    health_server.drop = True
+    assert liveness()
+    health_server.drop = False
+    assert liveness() and liveness.cause is None
+    assert len(health_server.requests) == 4
+    assert len(set(health_server.requests)) == 2
+
+
+def test_http_probe_failures(health_server):
+    liveness = watson.LivenessByHTTPGet(health_server.url, okay=(200, 204), pattern="^OK$")
+    health_server.status = 500
+    assert not liveness() and liveness.cause == "status"
+    health_server.status = 204
+    health_server.body = "DEGRADED"
+    assert not liveness() and liveness.cause == "mismatch"
+    assert watson.LivenessByHTTPGet(health_server.url, method="HEAD", okay=(204,), pattern="^OK$")()
+
+
+def test_http_probe_timeout(health_server):
+    """Test that a check of a hung service fails once the read timeout is up, and is not retried"""
+
+    liveness = watson.LivenessByHTTPGet(health_server.url, read_timeout=0.2)
+    assert liveness()
+    health_server.delay = 1
+    started = time.time()
+    assert not liveness()
+    assert time.time() - started < 0.9
+    assert liveness.cause == "timeout"
+    assert liveness.connection is None
+    assert len(health_server.requests) == 2
+
+
+def test_current_weight(monkeypatch):
+    """Test that the weight falls with the latency beyond weight_latency and with the load the service reports"""
+
+    service = make_watson(monkeypatch, publish_weight="true", weight_latency=100)
+    service.latency = 0.05
+    assert service.current_weight() == 100
+    service.latency = 0.2
+    assert service.current_weight() == 50
+    service.latency = 0.1
+    service.testLiveness.load = 0.75
+    assert service.current_weight() == 25
+    service.testLiveness.load = 1.0
+    assert service.current_weight() == 1
+    service.testLiveness.load = None
+    service.latency = 0
+    assert service.current_weight() == 100
+
+
+def test_weight_republish_threshold(monkeypatch):
+    """Test that the weight is only republished once it changed by more than a fifth and weight_interval has passed"""
+
+    service = make_watson(monkeypatch, rise=1, publish_weight="true", weight_latency=100, weight_interval=30)
+    probe(service, True)
+    assert Tether.registered == ["http://localhost:9000#weight=100"]
+
+    service.weightTime -= 60
+    service.latency = 0.115
+    service.update_weight(Reactor())
+    assert Tether.registered == ["http://localhost:9000#weight=100"]
+
+    service.latency = 0.2
+    service.weightTime += 60
+    service.update_weight(Reactor())
+    assert Tether.registered == ["http://localhost:9000#weight=100"]
+
+    service.weightTime -= 31
+    service.update_weight(Reactor())
+    assert Tether.registered == ["http://localhost:9000#weight=50"]
+    assert service.metrics.weight == 50
+
+
+def test_weight_is_not_published_by_default(monkeypatch):
+    service = make_watson(monkeypatch, rise=1)
+    probe(service, True)
+    service.latency = 5
+    probe(service, True)
+    assert Tether.registered == ["http://localhost:9000"]
+
+
+def test_tcp_probe():
+    listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    listener.bind(("127.0.0.1", 0))
+    listener.listen(5)
+    port = listener.getsockname()[1]
+    liveness = watson.LivenessByConnect("tcp://127.0.0.1:%d" % port)
+    assert liveness() and liveness.cause is None
+    listener.close()
+    assert not liveness()
+    assert liveness.cause == "refused"
+
+
+def test_unix_probe(tmpdir):
+    path = str(tmpdir.join("service.sock"))
+    liveness = watson.LivenessByUnixConnect("unix://" + path)
+    assert not liveness()
+    assert liveness.cause == "refused"
+
+    listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    listener.bind(path)
+    listener.listen(5)
+    try:
+        assert liveness() and liveness.cause is None
+    finally:
+        listener.close()
+
+
+def test_exec_probe(tmpdir):
+    """Test that a command must exit with status 0 in time, and is killed along with its children if it does not"""
+
+    assert watson.LivenessByExec("true")()
+    liveness = watson.LivenessByExec("exit 3")
+    assert not liveness()
+    assert liveness.cause == "exit"
+
+    marker = tmpdir.join("survived")
+    liveness = watson.LivenessByExec("(sleep 1; touch %s) & wait" % marker, timeout=0.2)
+    started = time.time()
+    assert not liveness()
+    assert time.time() - started < 0.9
+    assert liveness.cause == "timeout"
+    time.sleep(1.2)
+    assert not marker.check()
+
+
+class Clock(object):
+
+    def __init__(self, now=1000.0):
+        self.now = now
+
+    def __call__(self):
+        return self.now
+
+
+def test_service_metrics_streaks():
+    """Test that failures are counted by cause and that a passing check ends the current failure streak"""
+
+    metrics = watson.Metrics().service("svc")
+    for alive, cause in [(False, "timeout"), (False, "refused"), (False, "timeout"), (True, None), (False, "status")]:
+        metrics.probed(alive, 0.02, cause)
+    snapshot = metrics.snapshot()
+    assert snapshot["probes"] == 5
+    assert snapshot["failures"] == {"timeout": 2, "refused": 1, "status": 1}
+    assert (snapshot["failure_streak"], snapshot["longest_failure_streak"]) == (1, 3)
+    assert snapshot["probe_seconds"]["count"] == 5
+
+
+def test_service_metrics_transitions(monkeypatch):
+    """Test that state changes are counted and the time spent in each state is kept, including the current stay"""
+
+    clock = Clock()
+    monkeypatch.setattr(watson, "time", clock)
+    metrics = watson.Metrics().service("svc")
+    clock.now += 4
+    metrics.transition("LIVE", confirm_seconds=4)
+    clock.now += 10
+    metrics.transition("LIVE")
+    metrics.transition("DEAD", confirm_seconds=2)
+    clock.now += 3
+    metrics.transition("LIVE", confirm_seconds=1)
+    clock.now += 5
+
+    snapshot = metrics.snapshot()
+    assert snapshot["state"] == "LIVE"
+    assert snapshot["state_seconds"] == {"START": 4.0, "LIVE": 15.0, "DEAD": 3.0}
+    assert snapshot["transitions"] == {"START -> LIVE": 1, "LIVE -> DEAD": 1, "DEAD -> LIVE": 1}
+    assert snapshot["confirm_seconds"]["count"] == 3
+    assert snapshot["confirm_seconds"]["sum"] == 7
+
+
+def test_watson_records_transitions(monkeypatch):
+    service = make_watson(monkeypatch, rise=1, fall=2, flap_half_life=0)
+    probe(service, False, False, True, False, False)
+    snapshot = service.prober.metrics.snapshot()["services"]["svc"]
+    assert snapshot["transitions"] == {"START -> DEAD": 1, "DEAD -> LIVE": 1, "LIVE -> DEAD": 1}
+    assert snapshot["tether_start_seconds"]["count"] == 1
+    assert snapshot["tether_stop_seconds"]["count"] == 1
+    assert snapshot["failures"] == {"refused": 4}
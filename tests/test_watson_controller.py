@@ -0,0 +1,193 @@
+import imp
+import itertools
+import json
+import os
+import signal
+
+import pytest
+
+pytest.importorskip("flask")
+pytest.importorskip("yaml")
+
+REPO_ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), ".."))
+controller = imp.load_source("watson_controller", os.path.join(REPO_ROOT, "resources", "infrastructure-setup", "bin",
+                                                               "watson_controller.py"))
+
+
+class Popen(object):
+
+    """Stands in for the Watson processes the controller starts and records how each was started"""
+
+    pids = itertools.count(100)
+    started = []
+
+    def __init__(self, args):
+        self.pid = next(Popen.pids)
+        Popen.started.append((self.pid, args))
+
+
+class Timer(object):
+
+    """Stands in for the stop timeout, which the tests fire themselves"""
+
+    scheduled = []
+
+    def __init__(self, interval, function, args):
+        self.function = function
+        self.args = args
+        self.daemon = False
+
+    def start(self):
+        Timer.scheduled.append(self)
+
+
+class Children(object):
+
+    """The exit status waitpid reports for each child; children without one are still running"""
+
+    def __init__(self):
+        self.exited = {}  # pid -> status
+        self.signals = []  # (pid, signal)
+
+    def kill(self, pid, sig):
+        self.signals.append((pid, sig))
+
+    def waitpid(self, pid, options):
+        assert options == os.WNOHANG
+        if pid not in self.exited:
+            return 0, 0
+        status = self.exited.pop(pid)
+        if status is None:
+            raise OSError(10, "No child processes")
+        return pid, status
+
+
+@pytest.fixture
+def children(tmpdir, monkeypatch):
+    configs = tmpdir.mkdir("configs")
+    monkeypatch.setattr(controller, "DATAWIRE_CONFIG_ROOT", str(configs))
+    monkeypatch.setattr(controller, "WATSON_EXECUTABLE_PATH", "/usr/bin/watson")
+    monkeypatch.setattr(controller, "WATSON_CHECKS_PER_WORKER", 1)
+    monkeypatch.setattr(controller, "GROUP_CONFIG_DIR", str(tmpdir.mkdir("groups")))
+    for name in ("WATSON_INSTANCES", "WATSON_WORKERS", "WATSON_GROUP_CONFIGS", "WATSON_CONFIG_MTIMES"):
+        monkeypatch.setattr(controller, name, {})
+    monkeypatch.setattr(controller, "STOPPING", set())
+    monkeypatch.setattr(controller, "CONFIG_INDEX", dict(mtime=None, configs=[]))
+
+    children = Children()
+    monkeypatch.setattr(controller.subprocess, "Popen", Popen)
+    monkeypatch.setattr(Popen, "started", [])
+    monkeypatch.setattr(controller, "Timer", Timer)
+    monkeypatch.setattr(Timer, "scheduled", [])
+    monkeypatch.setattr(controller.os, "kill", children.kill)
+    monkeypatch.setattr(controller.os, "waitpid", children.waitpid)
+
+    for service in ("a", "b", "c"):
+        configs.join("watson-%s.conf" % service).write(
+            "[Watson]\nservice_url: http://localhost:900%d\n\n[Logging]\nlevel: INFO\n" % (ord(service) - ord("a")))
+    return children
+
+
+def call(method, url):
+    response = getattr(controller.app.test_client(), method)(url)
+    return response.status_code, json.loads(response.data) if response.data else None
+
+
+def config_path(name):
+    return os.path.join(controller.DATAWIRE_CONFIG_ROOT, name)
+
+
+def test_bulk_start(children):
+    """Test that all configurations are started at once, several to a Watson, and that only the rest is started later"""
+
+    assert call("post", "/watsons?all=true&per_worker=2") == (200, dict(started=["watson-a.conf", "watson-b.conf",
+                                                                                  "watson-c.conf"],
+                                                                         unknown=[], running=[]))
+    (group_pid, group_args), (pid, args) = Popen.started
+    assert args == ["/usr/bin/watson", "-c", config_path("watson-c.conf")]
+    assert group_args[:2] == ["/usr/bin/watson", "-c"]
+    group_config = open(group_args[2]).read()
+    assert "[Watson:a]\nservice_url = http://localhost:9000\n" in group_config
+    assert "[Watson:b]\nservice_url = http://localhost:9001\n" in group_config
+    assert group_config.count("[Logging]") == 1
+    assert controller.WATSON_INSTANCES == {"watson-a.conf": group_pid, "watson-b.conf": group_pid,
+                                           "watson-c.conf": pid}
+    assert controller.WATSON_WORKERS == {group_pid: ["watson-a.conf", "watson-b.conf"], pid: ["watson-c.conf"]}
+
+    assert call("post", "/watsons?config_name=watson-a.conf&config_name=watson-x.conf") == (
+        400, dict(started=[], unknown=["watson-x.conf"], running=["watson-a.conf"]))
+    assert call("post", "/watsons?all=true") == (200, dict(started=[], unknown=[], running=["watson-a.conf",
+                                                                                            "watson-b.conf",
+                                                                                            "watson-c.conf"]))
+    assert len(Popen.started) == 2
+
+
+def test_bulk_stop(children):
+    """Test that stopping some configurations of a Watson restarts it with the others, and that all can be stopped"""
+
+    call("post", "/watsons?all=true&per_worker=2")
+    (group_pid, group_args), (pid, _) = Popen.started
+    assert call("delete", "/watsons?config_name=watson-a.conf") == (200, dict(stopped=["watson-a.conf"]))
+    assert children.signals == [(group_pid, signal.SIGTERM)]
+    assert not os.path.exists(group_args[2])
+    restarted, args = Popen.started[-1]
+    assert args == ["/usr/bin/watson", "-c", config_path("watson-b.conf")]
+    assert controller.WATSON_INSTANCES == {"watson-b.conf": restarted, "watson-c.conf": pid}
+    assert controller.STOPPING == set([group_pid])
+
+    _, body = call("delete", "/watsons?all=true")
+    assert sorted(body["stopped"]) == ["watson-b.conf", "watson-c.conf"]
+    assert controller.WATSON_INSTANCES == {} and controller.WATSON_WORKERS == {}
+    assert controller.STOPPING == set([group_pid, restarted, pid])
+    assert len(Popen.started) == 3
+
+
+def test_reload(children):
+    """Test that a reload restarts Watsons whose configuration changed and stops those whose configuration is gone"""
+
+    call("post", "/watsons?all=true")
+    pids = dict(controller.WATSON_INSTANCES)
+    assert call("post", "/watsons/reload") == (200, dict(reloaded=[]))
+
+    mtime = os.stat(config_path("watson-b.conf")).st_mtime
+    os.utime(config_path("watson-b.conf"), (mtime + 10, mtime + 10))
+    os.remove(config_path("watson-c.conf"))
+    os.utime(controller.DATAWIRE_CONFIG_ROOT, (mtime + 10, mtime + 10))
+    assert call("post", "/watsons/reload") == (200, dict(reloaded=["watson-b.conf"]))
+    assert sorted(children.signals) == [(pids["watson-b.conf"], signal.SIGTERM),
+                                        (pids["watson-c.conf"], signal.SIGTERM)]
+    assert controller.WATSON_INSTANCES == {"watson-a.conf": pids["watson-a.conf"],
+                                           "watson-b.conf": Popen.started[-1][0]}
+
+    assert call("post", "/watsons/reload?config_name=watson-a.conf") == (200, dict(reloaded=["watson-a.conf"]))
+    assert controller.WATSON_INSTANCES["watson-a.conf"] == Popen.started[-1][0]
+    assert call("post", "/watsons/reload") == (200, dict(reloaded=[]))
+
+
+def test_reaping(children):
+    """Test that Watsons that exit on their own are forgotten, and stopped ones are only killed if they do not exit"""
+
+    call("post", "/watsons?all=true")
+    pids = dict(controller.WATSON_INSTANCES)
+    assert not controller.reap(pids["watson-a.conf"])
+    children.exited[pids["watson-a.conf"]] = 256
+    assert controller.reap(pids["watson-a.conf"])
+    assert "watson-a.conf" not in controller.WATSON_INSTANCES
+    assert call("get", "/watsons/watson-a.conf")[0] == 404
+
+    call("delete", "/watsons?config_name=watson-b.conf&config_name=watson-c.conf")
+    stop_b, stop_c = sorted(Timer.scheduled, key=lambda timer: timer.args)
+    children.exited[pids["watson-b.conf"]] = 0
+    children.exited[pids["watson-c.conf"]] = None  # reaped by someone else
+    assert controller.reap(pids["watson-b.conf"]) and controller.reap(pids["watson-c.conf"])
+    assert controller.STOPPING == set()
+    stop_b.function(*stop_b.args)
+    stop_c.function(*stop_c.args)
+    assert signal.SIGKILL not in [sig for _, sig in children.signals]
+
+    call("post", "/watsons?config_name=watson-b.conf")
+    pid = controller.WATSON_INSTANCES["watson-b.conf"]
+    controller.restart_workers(["watson-b.conf"], stop=True)
+    assert not controller.reap(pid)
+    Timer.scheduled[-1].function(*Timer.scheduled[-1].args)
+    assert children.signals[-1] == (pid, signal.SIGKILL)